@@ -11,12 +11,14 @@ autonomous navigation and mapping
 # Standard library imports
 import os
 import time
+import atexit
 import json
+import queue
 import base64
 import shutil
 import pickle
 import argparse
-from datetime import datetime
+import threading
 from io import BytesIO, StringIO
 
 # Related third party imports
@@ -48,7 +50,7 @@ ground_truth = mpimg.imread('../calibration_images/map_bw.png')
 # map output looks green in the display image
 ground_truth_3d = np.dstack(
     (ground_truth*0, ground_truth*255, ground_truth*0)
-).astype(np.float)
+).astype(np.float32)
 
 
 class RoverTelemetry():
@@ -81,7 +83,8 @@ class RoverTelemetry():
 
         self.nav_dists = None  # Distances to navigable terrain pixels
         self.nav_angles = None  # Angles of navigable terrain pixels
-        self.nav_angles_left = None  # Nav terrain angles left of rover heading
+        self.nav_angles_left_count = 0  # Nav pixels left of rover heading
+        self.nav_angles_left_mean = None  # Mean nav angle left of heading
 
         self.obs_dists = None  # Distances to obstacle terrain pixels
         self.obs_angles = None  # Angles of obstacle terrain pixels
@@ -105,15 +108,23 @@ class RoverTelemetry():
 
         # Rover vision image to be updated with displays of
         # intermediate analysis steps on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float)
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.float32)
 
         # Worldmap image to be updated with the positions of
         # ROIs navigable terrain, obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float)
+        # (holds number of frames each map cell was seen in, scaled to
+        # 0-255 for display; counts saturate at the uint16 maximum)
+        self.worldmap = np.zeros((200, 200, 3), dtype=np.uint16)
         self.ground_truth = ground_truth_3d  # Ground truth worldmap
         # To update % of ground truth map successfully found
         self.perc_mapped = 0
 
+        # Scratch binary images of navigable terrain, obstacles and rock
+        # samples, in camera view and warped perspective view, reused by
+        # perception on every frame instead of being reallocated
+        self.thresh_imgs = np.zeros((3, 160, 320), dtype=np.uint8)
+        self.thresh_imgs_pf = np.zeros((3, 160, 320), dtype=np.uint8)
+
 
 # Initialize our rover
 Rover = RoverTelemetry()
@@ -129,6 +140,44 @@ frame_counter = 0
 second_counter = time.time()
 fps = None
 
+# Index of recorded image frames, used to name and order saved images
+image_idx = 0
+
+
+# Queue of camera frames waiting to be saved by the image saver thread
+image_queue = queue.Queue(maxsize=64)
+
+# Number of camera frames dropped because the image queue was full
+dropped_images = 0
+
+
+def save_images():
+    """
+    Save queued camera frames to disk.
+
+    Runs on its own thread so that JPEG encoding and disk writes do not
+    block the telemetry handler
+
+    """
+    while True:
+        image, image_path = image_queue.get()
+        # Keep the saver alive on any error, so every queued frame is
+        # marked done and finish_saving_images cannot block forever
+        try:
+            image.save(image_path)
+        except Exception as err:
+            print("Failed to save image {}: {}".format(image_path, err))
+        finally:
+            image_queue.task_done()
+
+
+def finish_saving_images():
+    """Wait for queued camera frames to be saved before exiting."""
+    print("Saving remaining {} images ...".format(image_queue.qsize()))
+    image_queue.join()
+    if dropped_images:
+        print("Dropped {} images while recording".format(dropped_images))
+
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
@@ -140,7 +189,7 @@ def telemetry(sid, data):
     (nominally 25 times per second)
 
     """
-    global frame_counter, second_counter, fps
+    global frame_counter, second_counter, fps, image_idx, dropped_images
     frame_counter += 1
     # Do a rough calculation of frames per second (FPS)
     if (time.time() - second_counter) > 1:
@@ -189,9 +238,14 @@ def telemetry(sid, data):
         # Example: $ python drive_rover.py image_folder_path
         # Conditional to save image frame if folder was specified
         if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+            image_idx += 1
+            image_path = '{}/{:09d}.jpg'.format(args.image_folder, image_idx)
+            # Drop the frame rather than stall telemetry if saver lags
+            try:
+                image_queue.put_nowait((image, image_path))
+            except queue.Full:
+                # Reported once in total by finish_saving_images
+                dropped_images += 1
 
     else:
         sio.emit('manual', data={}, skip_sid=True)
@@ -258,6 +312,9 @@ if __name__ == '__main__':
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
         print("Recording this run ...")
+        threading.Thread(target=save_images, daemon=True).start()
+        # Flush queued frames on shutdown since the saver thread is daemonic
+        atexit.register(finish_saving_images)
     else:
         print("NOT recording this run ...")
 
@@ -42,7 +42,7 @@ def left_path_clear(Rover, safe_pixs=1500):
     Keyword arguments:
     safe_pixs -- minimum number of pixels on left to deem left path clear
     """
-    nav_pixs_left = len(Rover.nav_angles_left)
+    nav_pixs_left = Rover.nav_angles_left_count
     return nav_pixs_left >= safe_pixs
 
 
@@ -65,8 +65,8 @@ def pointed_along_wall(Rover, safe_pixs=500, wall_angle_bias=-10):
     safe_pixs --  minimum number of pixels to keep from wall
     wall_angle_bias -- to bias rover heading for pointing along wall (degrees)
     """
-    nav_pixs_left = len(Rover.nav_angles_left)
-    nav_heading_left = np.mean(Rover.nav_angles_left) + wall_angle_bias
+    nav_pixs_left = Rover.nav_angles_left_count
+    nav_heading_left = Rover.nav_angles_left_mean + wall_angle_bias
 
     return (nav_pixs_left >= safe_pixs
             and nav_heading_left > 0)
@@ -79,7 +79,7 @@ def deviated_from_wall(Rover, max_angle_wall=25):
     Keyword arguments:
     max_angle_wall --  maximum allowed angle from left wall (degrees)
     """
-    nav_heading_left = np.mean(Rover.nav_angles_left)
+    nav_heading_left = Rover.nav_angles_left_mean
     return nav_heading_left > max_angle_wall
 
 
@@ -102,7 +102,7 @@ def at_left_obstacle(Rover, safe_pixs=50):
     safe_pixs -- minimum number of pixels to keep from left obstacles
     """
 
-    nav_pixs_left = len(Rover.nav_angles_left)
+    nav_pixs_left = Rover.nav_angles_left_count
     return nav_pixs_left < safe_pixs
 
 
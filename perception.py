@@ -33,15 +33,27 @@ wf -- world frame
 """
 
 
-
+import math
+from functools import lru_cache
 from collections import namedtuple
 
 import numpy as np
 import cv2
 
+from perception_kernels import (color_thresh_kernel,
+                                extract_rf_points_kernel,
+                                positive_sum_count, rover_to_world_kernel)
+
+
+# Named tuples returned by the functions below, defined once at import
+# rather than rebuilt on every call
+ThreshedImages = namedtuple('ThreshedImages', 'nav obs rock')
+PixPoints = namedtuple('PixPoints', 'x y')
+
 
 def color_thresh(input_img, rgb_thresh=(160, 160, 160),
-                 low_bound=(75, 130, 130), upp_bound=(255, 255, 255)):
+                 low_bound=(75, 130, 130), upp_bound=(255, 255, 255),
+                 dst_imgs=None):
     """
     Apply color thresholds to extract pixels of navigable/obstacles/rocks.
 
@@ -49,64 +61,55 @@ def color_thresh(input_img, rgb_thresh=(160, 160, 160),
     input_img -- numpy image on which RGB threshold is applied
     rgb_thresh -- RGB thresh tuple above which only ground pixels are detected
     low/up_bounds -- HSV tuples defining color range of gold rock samples
+    dst_imgs -- optional preallocated C-ordered 3 x height x width uint8
+                array of nav/obs/rock images to fill, only used if it
+                matches the xy size of input_img
 
     Return value:
     thresh_imgs -- namedtuple of binary images identifying nav/obs/rock pixels
 
     """
-    # Create arrays of zeros same xy size as input_img, but single channel
-    nav_img = np.zeros_like(input_img[:, :, 0])
-    obs_img = np.zeros_like(input_img[:, :, 0])
-
-    # Convert BGR input_img to HSV for rock samples
-    hsv_img = cv2.cvtColor(input_img, cv2.COLOR_BGR2HSV)
-
-    # Require that each of the R(0), G(1), B(2) pixels be above all three
-    # rgb_thresh values such that pixpts_above_thresh will now contain a
-    # boolean array with "True" where threshold was met
-    pixpts_above_thresh = ((input_img[:, :, 0] > rgb_thresh[0])
-                           & (input_img[:, :, 1] > rgb_thresh[1])
-                           & (input_img[:, :, 2] > rgb_thresh[2]))
-
-    pixpts_nonzero = ((input_img[:, :, 0] > 0)
-                      & (input_img[:, :, 1] > 0)
-                      & (input_img[:, :, 2] > 0))
-
-    # obstacle pixels are those non-zero pixels where rgb_thresh was not met
-    obs_pixpts = np.logical_and(
-        pixpts_nonzero, np.logical_not(pixpts_above_thresh)
-        )
-    # Index the array of zeros with the boolean array and set to 1
-    # those pixels where ROI threshold was met
-    nav_img[pixpts_above_thresh] = 1
-    obs_img[obs_pixpts] = 1
-
-    # Threshold the HSV image to get only colors for gold rock samples
-    rock_img = cv2.inRange(hsv_img, low_bound, upp_bound)
+    # Kernel reads each pixel's channels as scalars from a C-ordered image
+    input_img = np.ascontiguousarray(input_img)
+
+    # Create arrays same xy size as input_img, but single channel, and fill
+    # them with the navigable/obstacle/rock pixels in one fused pass, with
+    # rock colors checked in HSV (input_img treated as BGR) without
+    # allocating the HSV image
+    # Kernel writes without bounds checks, so only reuse dst_imgs when it
+    # matches input_img, otherwise allocate new images like cv2 does
+    dst_shape = (3,) + input_img.shape[:2]
+    if (dst_imgs is None or dst_imgs.shape != dst_shape
+            or dst_imgs.dtype != np.uint8
+            or not dst_imgs.flags.c_contiguous):
+        dst_imgs = np.empty(dst_shape, dtype=np.uint8)
+    nav_img, obs_img, rock_img = dst_imgs
+    color_thresh_kernel(input_img, nav_img, obs_img, rock_img,
+                        tuple(rgb_thresh), tuple(low_bound), tuple(upp_bound))
 
     # Return the threshed binary images
-    ThreshedImages = namedtuple('ThreshedImages', 'nav obs rock')
     thresh_imgs = ThreshedImages(nav_img, obs_img, rock_img)
 
     return thresh_imgs
 
 
-def perspect_transform(src_img, dst_grid=10, bottom_offset=6):
+@lru_cache(maxsize=None)
+def perspect_matrix(height, width, dst_grid=10, bottom_offset=6):
     """
-    Apply a perspective transformation to input 3D image.
+    Compute the perspective transform matrix for rover camera images.
+
+    The calibration points are fixed, so the matrix is only computed once
+    for each image size and then reused on every frame.
 
     Keyword arguments:
-    src_img -- 3D numpy image on which perspective transform is applied
+    height, width -- dimension of source image from rover camera
     dst_grid -- size of 2D output image box of 10x10 pixels equaling 1 Sq m
     bottom_offset -- bottom of cam image is some distance in front of rover
 
     Return value:
-    dst_img -- 2D warped numpy image with overhead view
+    transform_matrix -- 3x3 numpy perspective transform matrix
 
     """
-    # Dimension of source image from rover camera
-    height, width = src_img.shape[0], src_img.shape[1]
-
     # Numpy array of four source points defining a grid on input 3D image
     # acquired from calibration data in test notebook
     src_x1, src_y1 = 14, 140
@@ -132,8 +135,33 @@ def perspect_transform(src_img, dst_grid=10, bottom_offset=6):
 
     transform_matrix = cv2.getPerspectiveTransform(src_points_3d,
                                                    dst_points_2d)
+
+    return transform_matrix
+
+
+def perspect_transform(src_img, dst_grid=10, bottom_offset=6,
+                       flags=cv2.INTER_LINEAR, dst_img=None):
+    """
+    Apply a perspective transformation to input 3D image.
+
+    Keyword arguments:
+    src_img -- 3D numpy image on which perspective transform is applied
+    dst_grid -- size of 2D output image box of 10x10 pixels equaling 1 Sq m
+    bottom_offset -- bottom of cam image is some distance in front of rover
+    flags -- cv2 interpolation method used for warping
+    dst_img -- optional preallocated output image to warp into
+
+    Return value:
+    dst_img -- 2D warped numpy image with overhead view
+
+    """
+    # Dimension of source image from rover camera
+    height, width = src_img.shape[0], src_img.shape[1]
+
+    transform_matrix = perspect_matrix(height, width, dst_grid, bottom_offset)
     # Keep same size as source image
-    dst_img = cv2.warpPerspective(src_img, transform_matrix, (width, height))
+    dst_img = cv2.warpPerspective(src_img, transform_matrix, (width, height),
+                                  dst=dst_img, flags=flags)
 
     return dst_img
 
@@ -158,8 +186,8 @@ def perspect_to_rover(binary_img):
     # Calculate pixel positions with reference to rover's coordinate
     # frame given that rover front camera itself is at center bottom
     # of the photographed image
-    xpix_pts_rf = -(ypix_pts_pf - height).astype(np.float)
-    ypix_pts_rf = -(xpix_pts_pf - width/2).astype(np.float)
+    xpix_pts_rf = -(ypix_pts_pf - height).astype(np.float32)
+    ypix_pts_rf = -(xpix_pts_pf - width/2).astype(np.float32)
     pixpts_rf = xpix_pts_rf, ypix_pts_rf
 
     return pixpts_rf
@@ -185,6 +213,32 @@ def to_polar_coords(pixpts):
     return dists, angles
 
 
+def extract_rf_points(binary_img, max_dist):
+    """
+    Get rover frame polar coords of ROI pixels and keep those nearby.
+
+    Extracting nonzero pixels, transforming them to rover frame,
+    converting to polar coords and filtering by distance are all done
+    in the same pass over the binary image.
+
+    Keyword arguments:
+    binary_img -- single channel 2D warped numpy image in perspective frame
+    max_dist -- only points closer than this are kept in pixpts_near
+
+    Return value:
+    dists, angles -- distance(m) and angles(deg) to all ROI pixels
+    pixpts_near -- tuple of int16 numpy arrays of pixel x,y points in
+                   rover frame within max_dist
+    angles_near -- angles(deg) to pixpts_near
+
+    """
+    (dists, angles, xpix_pts_near, ypix_pts_near,
+     angles_near) = extract_rf_points_kernel(binary_img, max_dist)
+    pixpts_near = xpix_pts_near, ypix_pts_near
+
+    return dists, angles, pixpts_near, angles_near
+
+
 def rotate_pixpts(pixpts, angle):
     """
     Geometrically rotate pixel points by specified angle.
@@ -201,11 +255,13 @@ def rotate_pixpts(pixpts, angle):
     angle_rad = angle*deg2rad
     xpix_pts, ypix_pts = pixpts
 
-    xpix_pts_rotated = xpix_pts*np.cos(angle_rad) - ypix_pts*np.sin(angle_rad)
-    ypix_pts_rotated = xpix_pts*np.sin(angle_rad) + ypix_pts*np.cos(angle_rad)
+    # Scalar trig results keep the float32 precision of the pixel points
+    cos_angle, sin_angle = math.cos(angle_rad), math.sin(angle_rad)
 
-    PixPointsRot = namedtuple('PixPointsRot', 'x y')
-    pixpts_rot = PixPointsRot(xpix_pts_rotated, ypix_pts_rotated)
+    xpix_pts_rotated = xpix_pts*cos_angle - ypix_pts*sin_angle
+    ypix_pts_rotated = xpix_pts*sin_angle + ypix_pts*cos_angle
+
+    pixpts_rot = PixPoints(xpix_pts_rotated, ypix_pts_rotated)
 
     return pixpts_rot
 
@@ -228,13 +284,29 @@ def translate_pixpts(pixpts_rot, translation, scale_factor=10):
     xpix_pts_translated = pixpts_rot.x/scale_factor + translation_x
     ypix_pts_translated = pixpts_rot.y/scale_factor + translation_y
 
-    PixPointsTran = namedtuple('PixPointsTran', 'x y')
-    pixpts_tran = PixPointsTran(xpix_pts_translated, ypix_pts_translated)
+    pixpts_tran = PixPoints(xpix_pts_translated, ypix_pts_translated)
 
     return pixpts_tran
 
 
-def rover_to_world(pixpts_rf, rover_pos, rover_yaw, world_size=200):
+def yaw_cos_sin(rover_yaw):
+    """
+    Compute cosine and sine of rover yaw angle.
+
+    Keyword arguments:
+    rover_yaw -- rover yaw angle in degrees
+
+    Return value:
+    cos_yaw, sin_yaw -- cosine and sine of rover yaw angle
+
+    """
+    yaw_rad = math.radians(rover_yaw)
+
+    return math.cos(yaw_rad), math.sin(yaw_rad)
+
+
+def rover_to_world(pixpts_rf, rover_pos, rover_yaw, world_size=200,
+                   scale_factor=10, yaw_trig=None):
     """
     Transform pixel points of ROIs from rover frame to world frame.
 
@@ -243,22 +315,33 @@ def rover_to_world(pixpts_rf, rover_pos, rover_yaw, world_size=200):
     rover_pos -- tuple of rover x,y position in world frame
     rover_yaw -- rover yaw angle in world frame
     world_size -- integer length of square world map of 200 x 200 pixels
+    scale_factor -- between world and rover frame pixels
+    yaw_trig -- optional tuple of precomputed cosine and sine of rover_yaw,
+                to share them between several calls for the same frame
 
     Return value:
     pixpts_wf -- namedtuple of numpy arrays of pixel x,y points in world frame
 
     """
-    # Apply rotation and translation
-    pixpts_rot = rotate_pixpts(pixpts_rf, rover_yaw)
-    pixpts_tran = translate_pixpts(pixpts_rot, rover_pos)
-
-    # Clip pixels to be within world size
-    xpix_pts_wf = np.clip(np.int_(pixpts_tran.x), 0, world_size-1)
-    ypix_pts_wf = np.clip(np.int_(pixpts_tran.y), 0, world_size-1)
+    # Kernel is compiled for contiguous int16 or float32 pixel points, so
+    # int16 points from extract_rf_points are passed through without a copy
+    xpix_pts_rf, ypix_pts_rf = (
+        np.ascontiguousarray(pts, dtype=(np.int16 if pts.dtype == np.int16
+                                         else np.float32))
+        for pts in map(np.asarray, pixpts_rf)
+        )
+    translation_x, translation_y = rover_pos
+    if yaw_trig is None:
+        yaw_trig = yaw_cos_sin(rover_yaw)
+    cos_yaw, sin_yaw = yaw_trig
+
+    # Apply rotation and translation, and clip pixels to be within world size
+    xpix_pts_wf, ypix_pts_wf = rover_to_world_kernel(
+        xpix_pts_rf, ypix_pts_rf, cos_yaw, sin_yaw,
+        translation_x, translation_y, scale_factor, world_size
+        )
 
-    # Define a named tuple for the points of the three ROIs
-    PixPointsWf = namedtuple('PixPointsWf', 'x y')
-    pixpts_wf = PixPointsWf(xpix_pts_wf, ypix_pts_wf)
+    pixpts_wf = PixPoints(xpix_pts_wf, ypix_pts_wf)
 
     return pixpts_wf
 
@@ -282,8 +365,7 @@ def inv_translate_pixpts(pixpts_wf, translation, scale_factor=10):
     xpix_pts_rotated = (xpix_pts_wf - translation_x)*scale_factor
     ypix_pts_rotated = (ypix_pts_wf - translation_y)*scale_factor
 
-    PixPointsRot = namedtuple('PixPointsRot', 'x y')
-    pixpts_rot = PixPointsRot(xpix_pts_rotated, ypix_pts_rotated)
+    pixpts_rot = PixPoints(xpix_pts_rotated, ypix_pts_rotated)
 
     return pixpts_rot
 
@@ -302,11 +384,11 @@ def inv_rotate_pixpts(pixpts_rot, angle):
     """
     deg2rad = np.pi/180.
     angle_rad = angle*deg2rad
+    cos_angle, sin_angle = math.cos(angle_rad), math.sin(angle_rad)
 
-    xpix_pts = pixpts_rot.x*np.cos(angle_rad) + pixpts_rot.y*np.sin(angle_rad)
-    ypix_pts = -pixpts_rot.x*np.sin(angle_rad) + pixpts_rot.y*np.cos(angle_rad)
+    xpix_pts = pixpts_rot.x*cos_angle + pixpts_rot.y*sin_angle
+    ypix_pts = -pixpts_rot.x*sin_angle + pixpts_rot.y*cos_angle
 
-    PixPoints = namedtuple('PixPoints', 'x y')
     pixpts = PixPoints(xpix_pts, ypix_pts)
 
     return pixpts
@@ -332,6 +414,35 @@ def world_to_rover(pixpts_wf, rover_pos, rover_yaw):
     return pixpts_rf
 
 
+def add_to_worldmap(worldmap, pixpts_wf, channel, value):
+    """
+    Add value once to each worldmap cell hit by pixel points in world frame.
+
+    Many rover frame pixels land on the same map cell in one frame, so
+    counting cells rather than pixels keeps the worldmap a count of the
+    frames each cell was seen in. Counts saturate at the largest value of
+    the worldmap's integer dtype rather than wrapping back to zero, since
+    perception keeps running after the mission time is up.
+
+    Keyword arguments:
+    worldmap -- 3D numpy worldmap image updated in place
+    pixpts_wf -- tuple of numpy arrays of x,y pixel points in world frame
+    channel -- index of the color channel to update
+    value -- amount added per map cell hit
+
+    """
+    xpix_pts_wf, ypix_pts_wf = pixpts_wf
+
+    max_count = np.iinfo(worldmap.dtype).max
+
+    # Buffered fancy indexing adds value once per map cell, even when
+    # several pixel points land on the same cell
+    map_cells = worldmap[ypix_pts_wf, xpix_pts_wf, channel]
+    worldmap[ypix_pts_wf, xpix_pts_wf, channel] = (
+        np.minimum(map_cells, max_count - value) + value
+        )
+
+
 def perception_step(Rover, R=0, G=1, B=2):
     """
     Sense environment with rover camera and update rover state accordingly.
@@ -341,11 +452,23 @@ def perception_step(Rover, R=0, G=1, B=2):
     R,G,B -- indexes representing the RGB color channels in a numpy image
 
     """
-    # Apply perspective transform to get 2D overhead view of rover cam
-    warped_img = perspect_transform(Rover.img)
+    # Only update worldmap (displayed on right) if rover has a stable drive
+    # High pitch/rolls cause inaccurate 3D to 2D mapping and low fidelity
+    is_stable = ((Rover.pitch > 359 and Rover.roll > 359)
+                 or (Rover.roll < 0.37 and Rover.pitch < 0.25))
 
     # Apply color thresholds to extract pixels of navigable/obstacles/rocks
-    thresh_pixpts_pf = color_thresh(warped_img)
+    # (reusing the rover's scratch images rather than allocating new ones)
+    thresh_pixpts = color_thresh(Rover.img, dst_imgs=Rover.thresh_imgs)
+
+    # Apply perspective transform to get 2D overhead view of each ROI
+    # (nearest neighbour interpolation keeps the warped images binary)
+    thresh_pixpts_pf = thresh_pixpts._make(
+        perspect_transform(binary_img, flags=cv2.INTER_NEAREST,
+                           dst_img=warped_img)
+        for binary_img, warped_img in zip(thresh_pixpts,
+                                          Rover.thresh_imgs_pf)
+        )
 
     # Update rover vision image with each ROI assigned to one of
     # the RGB color channels (to be displayed on left side of sim screen)
@@ -354,42 +477,48 @@ def perception_step(Rover, R=0, G=1, B=2):
     Rover.vision_image[:, :, G] = thresh_pixpts_pf.rock * VISION_G_VAL
     Rover.vision_image[:, :, B] = thresh_pixpts_pf.nav * VISION_B_VAL
 
-    # Transform pixel coordinates from perspective frame to rover frame
-    nav_pixpts_rf = perspect_to_rover(thresh_pixpts_pf.nav)
-    obs_pixpts_rf = perspect_to_rover(thresh_pixpts_pf.obs)
-    rock_pixpts_rf = perspect_to_rover(thresh_pixpts_pf.rock)
-
-    # Convert above cartesian coordinates to polar coordinates
-    Rover.nav_dists, Rover.nav_angles = to_polar_coords(nav_pixpts_rf)
-    Rover.obs_dists, Rover.obs_angles = to_polar_coords(obs_pixpts_rf)
-    Rover.rock_dists = to_polar_coords(rock_pixpts_rf)[0]
-
-    # Extract subset of nav_angles that are left of rover heading
-    Rover.nav_angles_left = Rover.nav_angles[Rover.nav_angles > 0]
-
-    # Only include pixels within certain distances from rover (for fidelity)
-    nav_pixpts_rf = [pts[Rover.nav_dists < 60] for pts in nav_pixpts_rf]
-    obs_pixpts_rf = [pts[Rover.obs_dists < 80] for pts in obs_pixpts_rf]
-    rock_pixpts_rf = [pts[Rover.rock_dists < 70] for pts in rock_pixpts_rf]
-
-    # Convert rock cartesian coords to polar coords
-    Rover.rock_angles = to_polar_coords(rock_pixpts_rf)[1]
-
-    # Transform pixel points of ROIs from rover frame to world frame
-    nav_pixpts_wf = rover_to_world(nav_pixpts_rf, Rover.pos, Rover.yaw)
-    obs_pixpts_wf = rover_to_world(obs_pixpts_rf, Rover.pos, Rover.yaw)
-    rock_pixpts_wf = rover_to_world(rock_pixpts_rf, Rover.pos, Rover.yaw)
-
-    # Only update worldmap (displayed on right) if rover has a stable drive
-    # High pitch/rolls cause inaccurate 3D to 2D mapping and low fidelity
+    # Transform ROI pixels from perspective frame to rover frame polar
+    # coords, and only keep pixels within certain distances from rover
+    # (for fidelity)
+    # (angles of nearby rocks are kept too, to steer towards samples)
+    Rover.nav_dists, Rover.nav_angles, nav_pixpts_rf, _ = extract_rf_points(
+        thresh_pixpts_pf.nav, 60
+        )
+    Rover.obs_dists, Rover.obs_angles, obs_pixpts_rf, _ = extract_rf_points(
+        thresh_pixpts_pf.obs, 80
+        )
+    (Rover.rock_dists, _, rock_pixpts_rf,
+     Rover.rock_angles) = extract_rf_points(thresh_pixpts_pf.rock, 70)
 
-    is_stable = ( (Rover.pitch > 359 and Rover.roll >359)
-                   or (Rover.roll < 0.37 and Rover.pitch < 0.25))
+    # Count and average nav_angles that are left of rover heading,
+    # without extracting them into a new array (NaN mean if there are none)
+    left_angles_sum, Rover.nav_angles_left_count = positive_sum_count(
+        Rover.nav_angles
+        )
+    if Rover.nav_angles_left_count > 0:
+        Rover.nav_angles_left_mean = (left_angles_sum
+                                      / Rover.nav_angles_left_count)
+    else:
+        Rover.nav_angles_left_mean = np.nan
+
+    # Skip world frame transforms when their results would be discarded
+    if not is_stable:
+        return Rover
+
+    # Transform pixel points of ROIs from rover frame to world frame,
+    # sharing the yaw trig between the three ROIs
+    yaw_trig = yaw_cos_sin(Rover.yaw)
+    nav_pixpts_wf, obs_pixpts_wf, rock_pixpts_wf = (
+        rover_to_world(pixpts_rf, Rover.pos, Rover.yaw, yaw_trig=yaw_trig)
+        for pixpts_rf in (nav_pixpts_rf, obs_pixpts_rf, rock_pixpts_rf)
+        )
 
-    if is_stable:  # Update map with each ROI assigned to an RGB color channel
-        MAP_R_VAL, MAP_G_VAL, MAP_B_VAL = 255, 255, 255
-        Rover.worldmap[obs_pixpts_wf.y, obs_pixpts_wf.x, R] += MAP_R_VAL
-        Rover.worldmap[rock_pixpts_wf.y, rock_pixpts_wf.x, G] += MAP_G_VAL
-        Rover.worldmap[nav_pixpts_wf.y, nav_pixpts_wf.x, B] += MAP_B_VAL
+    # Update map with each ROI assigned to an RGB color channel, counting
+    # the frames each map cell was seen in (scaled for display in
+    # create_output_images)
+    MAP_R_VAL, MAP_G_VAL, MAP_B_VAL = 1, 1, 1
+    add_to_worldmap(Rover.worldmap, obs_pixpts_wf, R, MAP_R_VAL)
+    add_to_worldmap(Rover.worldmap, rock_pixpts_wf, G, MAP_G_VAL)
+    add_to_worldmap(Rover.worldmap, nav_pixpts_wf, B, MAP_B_VAL)
 
     return Rover
@@ -0,0 +1,217 @@
+"""
+Numba kernels for the rover perception step.
+
+Kernels are compiled for explicit signatures when this module is
+imported, and cached on disk, so that the compilation cost is not paid
+on the first camera frames. They release the GIL while running.
+
+Short Forms:
+pixpts -- pixel points
+nav -- navigable terrain pixels
+obs -- obstacle pixels
+rock -- rock pixels
+
+"""
+
+
+
+import math
+
+import numpy as np
+from numba import njit, prange
+from numba.types import (Array, Tuple, UniTuple, void,
+                         int16, int64, uint8, float32, float64)
+
+
+# Array types of kernel arguments, camera images from PIL are read-only
+u8_3d = Array(uint8, 3, 'C')
+u8_3d_readonly = Array(uint8, 3, 'C', readonly=True)
+u8_2d = Array(uint8, 2, 'C')
+f32_1d = Array(float32, 1, 'C')
+i16_1d = Array(int16, 1, 'C')
+
+
+# Fixed-point division tables used by OpenCV for 8-bit BGR to HSV
+# conversion, so that rock pixels match cv2.cvtColor + cv2.inRange exactly
+HSV_SHIFT = 12
+HSV_SDIV_TABLE = np.zeros(256, dtype=np.int32)
+HSV_SDIV_TABLE[1:] = np.rint((255 << HSV_SHIFT) / np.arange(1., 256.))
+HSV_HDIV_TABLE = np.zeros(256, dtype=np.int32)
+HSV_HDIV_TABLE[1:] = np.rint((180 << HSV_SHIFT) / (6.*np.arange(1., 256.)))
+
+
+@njit([void(img, u8_2d, u8_2d, u8_2d, UniTuple(int64, 3),
+            UniTuple(int64, 3), UniTuple(int64, 3))
+       for img in (u8_3d, u8_3d_readonly)],
+      parallel=True, cache=True, nogil=True)
+def color_thresh_kernel(input_img, nav_img, obs_img, rock_img,
+                        rgb_thresh, low_bound, upp_bound):
+    """
+    Fill binary images of navigable/obstacle/rock pixels in a single pass.
+
+    Each pixel's three channels are loaded once as scalars straight from
+    the interleaved image, and used for both the RGB and HSV thresholds.
+
+    Keyword arguments:
+    input_img -- numpy image on which color thresholds are applied
+    nav_img, obs_img -- single channel uint8 output images (1 where met)
+    rock_img -- single channel uint8 output image (255 where in range)
+    rgb_thresh -- RGB thresh tuple above which only ground pixels are detected
+    low/upp_bound -- HSV tuples defining the inclusive rock color range,
+                     with input_img treated as BGR like cv2.COLOR_BGR2HSV
+
+    """
+    half = 1 << (HSV_SHIFT - 1)
+    height, width = input_img.shape[0], input_img.shape[1]
+    for row in prange(height):
+        for col in range(width):
+            chan0 = np.int32(input_img[row, col, 0])
+            chan1 = np.int32(input_img[row, col, 1])
+            chan2 = np.int32(input_img[row, col, 2])
+
+            # Ground pixels must be above all three rgb_thresh values, and
+            # obstacle pixels are those non-zero pixels where it was not met
+            above_thresh = (chan0 > rgb_thresh[0] and chan1 > rgb_thresh[1]
+                            and chan2 > rgb_thresh[2])
+            nonzero = chan0 > 0 and chan1 > 0 and chan2 > 0
+            nav_img[row, col] = above_thresh
+            obs_img[row, col] = nonzero and not above_thresh
+
+            # Convert pixel to HSV inline, same as cv2.COLOR_BGR2HSV
+            blue, green, red = chan0, chan1, chan2
+            val = max(red, green, blue)
+            diff = val - min(red, green, blue)
+            sat = (diff*HSV_SDIV_TABLE[val] + half) >> HSV_SHIFT
+            if val == red:
+                hue = green - blue
+            elif val == green:
+                hue = blue - red + 2*diff
+            else:
+                hue = red - green + 4*diff
+            hue = (hue*HSV_HDIV_TABLE[diff] + half) >> HSV_SHIFT
+            if hue < 0:
+                hue += 180
+
+            in_range = (low_bound[0] <= hue <= upp_bound[0]
+                        and low_bound[1] <= sat <= upp_bound[1]
+                        and low_bound[2] <= val <= upp_bound[2])
+            rock_img[row, col] = 255 if in_range else 0
+
+
+@njit(Tuple((f32_1d, f32_1d, i16_1d, i16_1d, f32_1d))(u8_2d, float64),
+      cache=True, nogil=True, fastmath=True)
+def extract_rf_points_kernel(binary_img, max_dist):
+    """
+    Extract rover frame polar coords of nonzero pixels in a single scan.
+
+    Keyword arguments:
+    binary_img -- single channel 2D warped numpy image in perspective frame
+    max_dist -- only points closer than this are kept in the filtered arrays
+
+    Return value:
+    dists, angles -- distance(m) and angles(deg) to all nonzero pixels
+    xpix_pts_near, ypix_pts_near -- int16 numpy arrays of rover frame
+                                    pixel x,y points closer than max_dist
+    angles_near -- angles(deg) to the pixel points closer than max_dist
+
+    """
+    rad2deg = 180./np.pi
+    height, width = binary_img.shape[0], binary_img.shape[1]
+    max_dist_sq = max_dist*max_dist
+
+    # Preallocate for the upper bound of every pixel being nonzero
+    dists = np.empty(height*width, dtype=np.float32)
+    angles = np.empty(height*width, dtype=np.float32)
+    xpix_pts_near = np.empty(height*width, dtype=np.int16)
+    ypix_pts_near = np.empty(height*width, dtype=np.int16)
+    angles_near = np.empty(height*width, dtype=np.float32)
+
+    num_pts = 0
+    num_near = 0
+    for row in range(height):
+        for col in range(width):
+            if binary_img[row, col] == 0:
+                continue
+            # Pixel position with reference to rover's coordinate frame
+            # given that rover front camera itself is at center bottom
+            # of the photographed image (whole pixels for even widths)
+            xpix = height - row
+            ypix = width//2 - col
+            dist_sq = xpix*xpix + ypix*ypix
+            angle = math.atan2(ypix, xpix)*rad2deg
+            dists[num_pts] = math.sqrt(dist_sq)
+            angles[num_pts] = angle
+            num_pts += 1
+            if dist_sq < max_dist_sq:
+                xpix_pts_near[num_near] = xpix
+                ypix_pts_near[num_near] = ypix
+                angles_near[num_near] = angle
+                num_near += 1
+
+    return (dists[:num_pts], angles[:num_pts],
+            xpix_pts_near[:num_near], ypix_pts_near[:num_near],
+            angles_near[:num_near])
+
+
+@njit(Tuple((float64, int64))(f32_1d,), cache=True, nogil=True)
+def positive_sum_count(values):
+    """
+    Sum and count the positive values of an array in a single pass.
+
+    Keyword arguments:
+    values -- float32 numpy array
+
+    Return value:
+    total, count -- sum and number of values greater than zero
+
+    """
+    total = 0.
+    count = 0
+    for idx in range(values.shape[0]):
+        if values[idx] > 0:
+            total += values[idx]
+            count += 1
+
+    return total, count
+
+
+@njit([UniTuple(i16_1d, 2)(pts, pts, float64, float64, float64,
+                           float64, int64, int64)
+       for pts in (i16_1d, f32_1d)],
+      cache=True, nogil=True, fastmath=True)
+def rover_to_world_kernel(xpix_pts, ypix_pts, cos_yaw, sin_yaw,
+                          translation_x, translation_y,
+                          scale_factor, world_size):
+    """
+    Rotate, translate and clip pixel points to world frame in one pass.
+
+    Keyword arguments:
+    xpix_pts, ypix_pts -- int16 or float32 numpy arrays of x,y pixel points
+                          in rover frame
+    cos_yaw, sin_yaw -- cosine and sine of rover yaw angle
+    translation_x, translation_y -- rover x,y position in world frame
+    scale_factor -- between world and rover frame pixels
+    world_size -- integer length of square world map
+
+    Return value:
+    xpix_pts_wf, ypix_pts_wf -- int16 numpy arrays of x,y pixel points
+                                in world frame
+
+    """
+    num_pts = xpix_pts.shape[0]
+    xpix_pts_wf = np.empty(num_pts, dtype=np.int16)
+    ypix_pts_wf = np.empty(num_pts, dtype=np.int16)
+
+    # Rotate in float32, promoting the pixel points only inside the loop
+    cos_yaw, sin_yaw = np.float32(cos_yaw), np.float32(sin_yaw)
+    for idx in range(num_pts):
+        xpix, ypix = np.float32(xpix_pts[idx]), np.float32(ypix_pts[idx])
+        xpix_rotated = xpix*cos_yaw - ypix*sin_yaw
+        ypix_rotated = xpix*sin_yaw + ypix*cos_yaw
+        # Truncate towards zero like np.int_, then clip to world size
+        xpix_wf = int(xpix_rotated/scale_factor + translation_x)
+        ypix_wf = int(ypix_rotated/scale_factor + translation_y)
+        xpix_pts_wf[idx] = min(max(xpix_wf, 0), world_size-1)
+        ypix_pts_wf[idx] = min(max(ypix_wf, 0), world_size-1)
+
+    return xpix_pts_wf, ypix_pts_wf
@@ -79,7 +79,7 @@ class FollowWall():
         """Execute the FollowWall state action."""
 
         # Add negative bias to nav angles left of rover to follow wall
-        wall_heading = np.mean(Rover.nav_angles_left) + self.WALL_ANGLE_OFFSET
+        wall_heading = Rover.nav_angles_left_mean + self.WALL_ANGLE_OFFSET
         # Drive below max velocity
         if Rover.vel < self.MAX_VEL:
             Rover.throttle = self.THROTTLE_SET
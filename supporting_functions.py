@@ -24,9 +24,9 @@ def convert_to_float(string_to_convert):
 
     """
     if ',' in string_to_convert:
-        float_value = np.float(string_to_convert.replace(',', '.'))
+        float_value = float(string_to_convert.replace(',', '.'))
     else:
-        float_value = np.float(string_to_convert)
+        float_value = float(string_to_convert)
     return float_value
 
 
@@ -100,6 +100,20 @@ def update_rover(Rover, data):
     return Rover, image
 
 
+def encode_image(img, quality=75):
+    """
+    Encode an RGB image as a base64 JPEG string.
+
+    Uses OpenCV's libjpeg-turbo encoder, which is faster than PIL's
+
+    """
+    bgr_img = cv2.cvtColor(img.astype(np.uint8), cv2.COLOR_RGB2BGR)
+    _, jpeg_buff = cv2.imencode(
+        '.jpg', bgr_img, [cv2.IMWRITE_JPEG_QUALITY, quality]
+    )
+    return base64.b64encode(jpeg_buff).decode("utf-8")
+
+
 def create_output_images(Rover, Decider):
     """Create display output given worldmap results."""
     # Create a scaled map for plotting and clean up obs/nav pixels a bit
@@ -119,7 +133,7 @@ def create_output_images(Rover, Decider):
 
     likely_nav = navigable >= obstacle
     obstacle[likely_nav] = 0
-    plotmap = np.zeros_like(Rover.worldmap)
+    plotmap = np.zeros(Rover.worldmap.shape, dtype=np.float32)
     plotmap[:, :, 0] = obstacle
     plotmap[:, :, 2] = navigable
     plotmap = plotmap.clip(0, 255)
@@ -150,19 +164,19 @@ def create_output_images(Rover, Decider):
 
     # Calculate some statistics on the map results
     # First get the total number of pixels in the navigable terrain map
-    tot_nav_pix = np.float(len((plotmap[:, :, 2].nonzero()[0])))
+    tot_nav_pix = float(len((plotmap[:, :, 2].nonzero()[0])))
     # Next figure out how many of those correspond to ground truth pixels
-    good_nav_pix = np.float(
+    good_nav_pix = float(
         len(((plotmap[:, :, 2] > 0) &
             (Rover.ground_truth[:, :, 1] > 0)).nonzero()[0])
     )
     # Next find how many do not correspond to ground truth pixels
-    bad_nav_pix = np.float(
+    bad_nav_pix = float(
         len(((plotmap[:, :, 2] > 0) &
             (Rover.ground_truth[:, :, 1] == 0)).nonzero()[0])
     )
     # Grab the total number of map pixels
-    tot_map_pix = np.float(len((Rover.ground_truth[:, :, 1].nonzero()[0])))
+    tot_map_pix = float(len((Rover.ground_truth[:, :, 1].nonzero()[0])))
 
     # Calculate % of ground truth map that has been successfully found
     Rover.perc_mapped = round(100*good_nav_pix / tot_map_pix, 1)
@@ -249,14 +263,7 @@ def create_output_images(Rover, Decider):
                 (5, 151), cv2.FONT_HERSHEY_COMPLEX, 0.53, (255, 255, 255), 1)
 
     # Convert map and vision image to base64 strings for sending to server
-    pil_img = Image.fromarray(map_add.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
-
-    pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
+    encoded_string1 = encode_image(map_add)
+    encoded_string2 = encode_image(Rover.vision_image)
 
     return encoded_string1, encoded_string2